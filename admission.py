@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Admission control for queries received by the daemon.
+
+Queries are sorted into classes (cheap lookups, per-user operations, heavy
+administrative operations), each with its own bounded queue and priority.
+Each class is served by a named worker: classes sharing a worker are served one
+query at a time, by priority, while classes on different workers run side by side.
+When a queue is full, or when a client already has too many queries in flight,
+the query is refused immediately with a "busy, retry after" answer instead of
+making the client hang until it times out.
+"""
+
+import threading
+from collections import deque
+from time import monotonic
+
+from log import logger
+
+
+class Busy(Exception):
+    """The query was refused because the daemon is overloaded"""
+
+    def __init__(self, reason, retry_after):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+    def to_dict(self):
+        return {
+            "success": False,
+            "busy": True,
+            "retry_after": self.retry_after,
+            "message": self.reason,
+        }
+
+
+class Request:
+    """
+    A query waiting in a queue, along with the client socket it came from.
+    """
+    def __init__(self, client, query, peer, klass):
+        self.client = client
+        self.query = query
+        self.peer = peer
+        self.klass = klass
+        self.enqueued = monotonic()
+        self.expired = False
+
+
+class QueryClass:
+    """
+    A class of queries sharing a queue, a priority and some statistics.
+    """
+    def __init__(self, name, priority, max_queue, max_wait, queries, worker="ipset"):
+        """
+        :param name: name of the class, used in logs and statistics.
+        :param priority: lower is served first, among the classes of the same worker.
+        :param max_queue: maximum number of queries waiting in the queue.
+        :param max_wait: seconds after which a waiting query is dropped, the client having most likely given up.
+        :param queries: names of the queries belonging to this class.
+        :param worker: name of the worker serving this class.
+        """
+        self.name = name
+        self.priority = priority
+        self.worker = worker
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.queries = set(queries)
+        self.queue = deque()
+        self.service_time = 0.01 # moving average, in seconds
+        self.stats = {
+            "admitted": 0,
+            "served": 0,
+            "expired": 0,
+            "rejected_queue_full": 0,
+            "rejected_client_limit": 0,
+            "max_depth": 0,
+        }
+
+    def to_dict(self):
+        res = dict(self.stats)
+        res["depth"] = len(self.queue)
+        res["priority"] = self.priority
+        res["worker"] = self.worker
+        res["service_time"] = round(self.service_time, 4)
+        return res
+
+
+class Admission:
+    """
+    Bounded, prioritized queues of queries, with a per-client concurrency limit.
+    Queries are submitted by the thread accepting connections and consumed by
+    one thread per worker.
+    """
+
+    def __init__(self, classes, max_client_inflight):
+        """
+        :param classes: dict mapping a class name to its parameters (see QueryClass).
+        :param max_client_inflight: maximum number of queries a single client may have queued or running. None for no limit.
+        """
+        self.classes = sorted((QueryClass(name, **params) for name, params in classes.items()),
+                              key=lambda c: c.priority)
+        self.by_query = {q: c for c in self.classes for q in c.queries}
+        self.max_client_inflight = max_client_inflight
+        self.inflight = dict()
+        self.cond = threading.Condition()
+
+    @property
+    def workers(self):
+        """
+        Names of the workers serving the classes, each needing its own thread.
+        """
+        return sorted(set(c.worker for c in self.classes))
+
+    def classify(self, query):
+        """
+        Find the class a query belongs to.
+
+        :param query: the query payload.
+        :return: QueryClass instance, None for unknown queries.
+        """
+        return self.by_query.get(query.get("query"))
+
+    def _retry_after(self, klass):
+        # everything of the same or higher priority on the same worker will be served first
+        ahead = sum(len(c.queue) * c.service_time for c in self.classes
+                    if c.worker == klass.worker and c.priority <= klass.priority)
+        return round(max(ahead, klass.service_time), 3)
+
+    def submit(self, client, query, peer=None):
+        """
+        Queue a query, or refuse it.
+
+        :param client: socket of the client, to answer on.
+        :param query: the query payload.
+        :param peer: identifier of the client for concurrency limits (its pid), None if unknown.
+        :raise Busy: the query was refused and should be answered right away.
+        :raise ValueError: the query is not part of any class.
+        """
+        klass = self.classify(query)
+        if klass is None:
+            raise ValueError("unknown query {}".format(query.get("query")))
+        with self.cond:
+            if len(klass.queue) >= klass.max_queue:
+                klass.stats["rejected_queue_full"] += 1
+                logger.warning("Queue %s full, refusing %s", klass.name, query.get("query"))
+                raise Busy("queue {} is full".format(klass.name), self._retry_after(klass))
+
+            if (peer is not None and self.max_client_inflight is not None
+                    and self.inflight.get(peer, 0) >= self.max_client_inflight):
+                klass.stats["rejected_client_limit"] += 1
+                logger.warning("Client %s has too many queries in flight, refusing %s", peer, query.get("query"))
+                raise Busy("too many queries in flight", self._retry_after(klass))
+
+            if peer is not None:
+                self.inflight[peer] = self.inflight.get(peer, 0) + 1
+            klass.queue.append(Request(client, query, peer, klass))
+            klass.stats["admitted"] += 1
+            klass.stats["max_depth"] = max(klass.stats["max_depth"], len(klass.queue))
+            # workers wait on the same condition, wake them all so the right one gets it
+            self.cond.notify_all()
+
+    def get(self, worker):
+        """
+        Wait for the next query to serve on a worker, highest priority first.
+        Queries which waited longer than their class allows are returned with
+        `expired` set, so that they can be answered as busy without being run.
+
+        :param worker: name of the worker asking for a query.
+        :return: Request instance. `done` must be called once it is answered.
+        """
+        with self.cond:
+            while True:
+                for klass in self.classes:
+                    if klass.worker == worker and klass.queue:
+                        request = klass.queue.popleft()
+                        if monotonic() - request.enqueued > klass.max_wait:
+                            request.expired = True
+                            klass.stats["expired"] += 1
+                            logger.warning("Dropping %s after waiting too long", request.query.get("query"))
+                        return request
+                self.cond.wait()
+
+    def busy(self, request):
+        """
+        Build the refusal for an expired request.
+
+        :param request: Request instance.
+        :return: Busy instance.
+        """
+        with self.cond:
+            return Busy("query waited too long", self._retry_after(request.klass))
+
+    def done(self, request, duration=None):
+        """
+        Mark a query as answered.
+
+        :param request: Request instance returned by `get`.
+        :param duration: time spent running it, in seconds, None if it was not run.
+        """
+        with self.cond:
+            if request.peer is not None:
+                left = self.inflight.get(request.peer, 1) - 1
+                if left:
+                    self.inflight[request.peer] = left
+                else:
+                    self.inflight.pop(request.peer, None)
+            if duration is not None:
+                klass = request.klass
+                klass.stats["served"] += 1
+                klass.service_time = 0.8 * klass.service_time + 0.2 * duration
+
+    def get_stats(self):
+        """
+        Get queue depths and admission counters.
+
+        :return: dict with the statistics of each class, and the number of clients with queries in flight.
+        """
+        with self.cond:
+            return {
+                "classes": {c.name: c.to_dict() for c in self.classes},
+                "clients_inflight": len(self.inflight),
+            }
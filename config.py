@@ -1,2 +1,20 @@
 mark = (100, 2)
 netcontrol_socket_file = "/var/run/langate2000-netcontrol.sock"
+
+# admission control: queries are queued by class, lower priority served first.
+# max_queue bounds each queue, max_wait (seconds) drops queries clients gave up on.
+# Classes on the same worker run one query at a time, lookups only read the ARP table
+# so they get their own worker instead of waiting behind ipset operations.
+query_classes = {
+    "lookup": {"priority": 0, "max_queue": 256, "max_wait": 2, "queries": ["get_mac", "get_ip"], "worker": "arp"},
+    "user": {"priority": 1, "max_queue": 128, "max_wait": 5, "queries": ["connect_user", "disconnect_user", "set_mark", "get_user_info"]},
+    "admin": {"priority": 2, "max_queue": 8, "max_wait": 10, "queries": ["clear", "destroy", "record_usage"]},
+}
+max_client_inflight = 4
+# seconds a client has to send its query, and the daemon to send the answer
+client_timeout = 2
+listen_backlog = 128
+
+# usage history: counters of every connected user are sampled every history_interval seconds
+history_dir = "/var/lib/langate2000-netcontrol/history"
+history_interval = 60
@@ -0,0 +1,434 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Persistent per-MAC usage history.
+
+Samples of the ipset byte and packet counters are appended to fixed-size records
+in a memory-mapped file, so that traffic history survives `clear` and `destroy`
+and can be analysed after the event.
+
+Two files live in the history directory:
+
+* samples.dat: a header followed by records (time, mac, bytes, packets, prev), in
+  the order they were appended, so sorted by time. `prev` links each record to the
+  previous sample of the same MAC (record number + 1, 0 for none).
+* index.dat: a header followed by one slot per MAC (mac, last record, sample count).
+
+Both headers hold a magic, a version, and the number of valid items. The number of
+items is only updated once an item is written, so readers never see partial records.
+The two files are not written atomically together: if the index does not match the
+records when the history is opened for writing, it is rebuilt from them.
+Counters are the raw ipset ones: they grow while an entry exists, and restart from 0
+when it is removed and added again. The daemon records a last sample before removing
+an entry and a zero sample when adding a new one, so restarts are explicit in the history.
+"""
+
+import mmap
+import os
+import struct
+import threading
+from collections import namedtuple
+from time import time
+
+from log import logger
+
+_HEADER = struct.Struct('<4sIQ') # magic, version, count
+_RECORD = struct.Struct('<d6s2xQQQ') # time, mac, bytes, packets, prev
+_SLOT = struct.Struct('<6s2xQQ') # mac, last, samples
+_VERSION = 1
+_GROW = 4096 # items added each time a file is full
+
+Sample = namedtuple("Sample", ["time", "mac", "bytes", "packets"])
+
+
+class HistoryError(RuntimeError):
+    """history files are missing or corrupted"""
+
+
+def _pack_mac(mac):
+    return bytes.fromhex(mac.replace(":", ""))
+
+
+def _unpack_mac(raw):
+    return ":".join("{:02X}".format(b) for b in raw)
+
+
+def _delta(previous, current):
+    """
+    Traffic between two samples of a counter, accounting for counter restarts.
+    """
+    return current - previous if current >= previous else current
+
+
+class _MappedFile:
+    """
+    A memory-mapped file made of a header and fixed-size items.
+    """
+    def __init__(self, path, magic, item, writable):
+        self.path = path
+        self.magic = magic
+        self.item = item
+        self.writable = writable
+        self.map = None
+        if writable:
+            exists = os.path.exists(path) and os.path.getsize(path) >= _HEADER.size
+            self.file = open(path, "r+b" if exists else "w+b")
+        else:
+            try:
+                self.file = open(path, "rb")
+            except FileNotFoundError:
+                raise HistoryError("'{}' does not exist".format(path))
+        try:
+            if writable and exists:
+                # fill any hole left by an older version growing the file sparsely
+                self._reserve(os.path.getsize(path))
+            elif writable:
+                self.file.write(_HEADER.pack(magic, _VERSION, 0))
+                self._reserve(_HEADER.size + _GROW * item.size)
+            self._map()
+        except Exception:
+            self.close()
+            raise
+
+    def _reserve(self, size):
+        """
+        Allocate disk blocks for the whole file. Writing to a mapped page with no
+        block behind it would kill the process with SIGBUS once the disk is full,
+        allocating beforehand raises an OSError instead.
+
+        :param size: size of the file, in bytes.
+        """
+        self.file.flush()
+        os.posix_fallocate(self.file.fileno(), 0, size)
+
+    def _map(self):
+        if os.fstat(self.file.fileno()).st_size < _HEADER.size:
+            # mmap refuses empty files, report them as truncated too
+            raise HistoryError("'{}' is truncated".format(self.path))
+        self.map = mmap.mmap(self.file.fileno(), 0,
+                             access=mmap.ACCESS_WRITE if self.writable else mmap.ACCESS_READ)
+        magic, version, _ = _HEADER.unpack_from(self.map)
+        if magic != self.magic or version != _VERSION:
+            raise HistoryError("'{}' is not a version {} history file".format(self.path, _VERSION))
+
+    @property
+    def count(self):
+        # a reader's mapping may be shorter than what the writer already appended
+        return min(_HEADER.unpack_from(self.map)[2], self.capacity)
+
+    @property
+    def capacity(self):
+        return (len(self.map) - _HEADER.size) // self.item.size
+
+    def read(self, i):
+        return self.item.unpack_from(self.map, _HEADER.size + i * self.item.size)
+
+    def write(self, i, *values):
+        self.item.pack_into(self.map, _HEADER.size + i * self.item.size, *values)
+
+    def append(self, *values):
+        """
+        Write an item after the last one, growing the file if needed.
+
+        :return: number of the new item.
+        :raise OSError: the file could not grow, e.g. because the disk is full.
+        """
+        i = self.count
+        if i >= self.capacity:
+            self._reserve(_HEADER.size + (i + _GROW) * self.item.size)
+            self.map.flush()
+            self.map.close()
+            self._map()
+        self.write(i, *values)
+        _HEADER.pack_into(self.map, 0, self.magic, _VERSION, i + 1)
+        return i
+
+    def reset(self):
+        """
+        Forget all items, keeping the space allocated.
+        """
+        _HEADER.pack_into(self.map, 0, self.magic, _VERSION, 0)
+
+    def refresh(self):
+        """
+        Map again the file if the writer made it grow.
+        """
+        if os.fstat(self.file.fileno()).st_size != len(self.map):
+            self.map.close()
+            self._map()
+
+    def flush(self):
+        self.map.flush()
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+        self.file.close()
+
+
+class HistoryWriter:
+    """
+    Append counter samples to the history. Safe to use from several threads.
+    Timestamps must not go backward: they are clamped to the last one written.
+    """
+
+    def __init__(self, path):
+        """
+        Open the history, creating it if needed.
+
+        :param path: directory holding the history files.
+        """
+        os.makedirs(path, exist_ok=True)
+        self.records = _MappedFile(os.path.join(path, "samples.dat"), b"LGHS", _RECORD, True)
+        try:
+            self.index = _MappedFile(os.path.join(path, "index.dat"), b"LGHI", _SLOT, True)
+        except Exception:
+            self.records.close()
+            raise
+        self.slots = {self.index.read(i)[0]: i for i in range(self.index.count)}
+        count = self.records.count
+        if not self._index_valid():
+            logger.warning("Usage history index at %s does not match the samples, rebuilding it", path)
+            self._rebuild_index()
+        self.last_time = self.records.read(count - 1)[0] if count else 0.0
+        self.lock = threading.Lock()
+        logger.info("Opened usage history at %s (%s samples, %s MACs)", path, count, len(self.slots))
+
+    def _index_valid(self):
+        """
+        Check that every slot points to a record of its own MAC, and that the
+        slots account for all records.
+        """
+        count = self.records.count
+        if len(self.slots) != self.index.count:
+            return False # duplicate slots
+        total = 0
+        for i in range(self.index.count):
+            mac, last, samples = self.index.read(i)
+            if not 0 < last <= count or self.records.read(last - 1)[1] != mac:
+                return False
+            total += samples
+        return total == count
+
+    def _rebuild_index(self):
+        """
+        Rebuild the index and the chains of records from the records alone.
+        """
+        chains = dict() # mac -> [last, samples], in order of first sample
+        for i in range(self.records.count):
+            timestamp, mac, bytes, packets, prev = self.records.read(i)
+            last, samples = chains.get(mac, (0, 0))
+            if prev != last:
+                self.records.write(i, timestamp, mac, bytes, packets, last)
+            chains[mac] = (i + 1, samples + 1)
+        self.index.reset()
+        self.slots = {mac: self.index.append(mac, last, samples) for mac, (last, samples) in chains.items()}
+        self.records.flush()
+        self.index.flush()
+
+    def append(self, mac, bytes, packets, timestamp=None):
+        """
+        Append a single sample.
+        Raises OSError if the history files can't grow.
+
+        :param mac: mac address of the user.
+        :param bytes: value of the bytes counter.
+        :param packets: value of the packets counter.
+        :param timestamp: time of the sample, now if None.
+        """
+        raw = _pack_mac(mac)
+        with self.lock:
+            timestamp = max(time() if timestamp is None else timestamp, self.last_time)
+            slot = self.slots.get(raw)
+            if slot is None:
+                prev, samples = 0, 0
+            else:
+                _, prev, samples = self.index.read(slot)
+            record = self.records.append(timestamp, raw, bytes, packets, prev)
+            if slot is None:
+                self.slots[raw] = self.index.append(raw, record + 1, 1)
+            else:
+                self.index.write(slot, raw, record + 1, samples + 1)
+            self.last_time = timestamp
+
+    def append_all(self, counters, timestamp=None):
+        """
+        Append a sample for several users at once, all with the same timestamp.
+
+        :param counters: dict mapping mac address to a (bytes, packets) tuple.
+        :param timestamp: time of the samples, now if None.
+        """
+        timestamp = time() if timestamp is None else timestamp
+        for mac, (bytes, packets) in counters.items():
+            self.append(mac, bytes, packets, timestamp)
+        logger.debug("Recorded usage of %s MACs", len(counters))
+
+    def flush(self):
+        """
+        Write pending changes to disk.
+        """
+        with self.lock:
+            self.records.flush()
+            self.index.flush()
+
+    def close(self):
+        with self.lock:
+            self.records.close()
+            self.index.close()
+
+
+class HistoryReader:
+    """
+    Query the history. Records are read straight from the mapped files, so queries
+    over a whole event only keep a few values per MAC in memory.
+    The history may be read while the daemon writes to it, call `refresh` to see
+    the samples appended since the reader was opened.
+    """
+
+    def __init__(self, path):
+        """
+        :param path: directory holding the history files.
+        """
+        self.records = _MappedFile(os.path.join(path, "samples.dat"), b"LGHS", _RECORD, False)
+        try:
+            self.index = _MappedFile(os.path.join(path, "index.dat"), b"LGHI", _SLOT, False)
+        except Exception:
+            self.records.close()
+            raise
+
+    def refresh(self):
+        self.records.refresh()
+        self.index.refresh()
+
+    def close(self):
+        self.records.close()
+        self.index.close()
+
+    def __len__(self):
+        return self.records.count
+
+    def macs(self):
+        """
+        Get every MAC in the history.
+
+        :return: dict mapping mac address to its number of samples.
+        """
+        res = dict()
+        for i in range(self.index.count):
+            raw, _, samples = self.index.read(i)
+            res[_unpack_mac(raw)] = samples
+        return res
+
+    def _first(self, start):
+        """
+        Number of the first record at or after start, by binary search.
+        """
+        lo, hi = 0, self.records.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.records.read(mid)[0] < start:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _records(self, start, end):
+        count = self.records.count
+        i = 0 if start is None else self._first(start)
+        while i < count:
+            record = self.records.read(i)
+            if end is not None and record[0] >= end:
+                return
+            yield record
+            i += 1
+
+    def range(self, start=None, end=None):
+        """
+        Iterate over all samples in a time range, oldest first.
+
+        :param start: start of the range (included), None for the beginning.
+        :param end: end of the range (excluded), None for the end.
+        :return: iterator of Sample.
+        """
+        for timestamp, raw, bytes, packets, _ in self._records(start, end):
+            yield Sample(timestamp, _unpack_mac(raw), bytes, packets)
+
+    def samples(self, mac, start=None, end=None):
+        """
+        Get the samples of a single MAC in a time range, following its own chain
+        of records instead of scanning the whole history.
+
+        :param mac: mac address of the user.
+        :param start: start of the range (included), None for the beginning.
+        :param end: end of the range (excluded), None for the end.
+        :return: list of Sample, oldest first.
+        """
+        raw = _pack_mac(mac)
+        for i in range(self.index.count):
+            slot_mac, last, _ = self.index.read(i)
+            if slot_mac == raw:
+                break
+        else:
+            return []
+        res = []
+        while 0 < last <= self.records.count:
+            timestamp, record_mac, bytes, packets, last = self.records.read(last - 1)
+            if record_mac != raw:
+                # chain broken by a crash, the writer rebuilds it when reopening the history
+                break
+            if start is not None and timestamp < start:
+                break
+            if end is None or timestamp < end:
+                res.append(Sample(timestamp, mac.upper(), bytes, packets))
+        res.reverse()
+        return res
+
+    def _deltas(self, start, end):
+        """
+        Iterate over the traffic between each sample in range and the previous
+        sample of the same MAC, even if that one is before the range.
+        """
+        previous = dict()
+        for timestamp, raw, bytes, packets, prev in self._records(start, end):
+            if raw in previous:
+                last_bytes, last_packets = previous[raw]
+            elif 0 < prev <= self.records.count and self.records.read(prev - 1)[1] == raw:
+                last_bytes, last_packets = self.records.read(prev - 1)[2:4]
+            else:
+                last_bytes, last_packets = 0, 0
+            previous[raw] = (bytes, packets)
+            yield timestamp, raw, _delta(last_bytes, bytes), _delta(last_packets, packets)
+
+    def usage(self, start=None, end=None):
+        """
+        Get the traffic of every MAC in a time range.
+
+        :param start: start of the range (included), None for the beginning.
+        :param end: end of the range (excluded), None for the end.
+        :return: dict mapping mac address to a (bytes, packets) tuple.
+        """
+        totals = dict()
+        for _, raw, bytes, packets in self._deltas(start, end):
+            total_bytes, total_packets = totals.get(raw, (0, 0))
+            totals[raw] = (total_bytes + bytes, total_packets + packets)
+        return {_unpack_mac(raw): total for raw, total in totals.items()}
+
+    def timeline(self, step, start=None, end=None):
+        """
+        Get the traffic of all MACs together, in buckets of fixed duration.
+
+        :param step: duration of a bucket, in seconds.
+        :param start: start of the range (included), None for the beginning.
+        :param end: end of the range (excluded), None for the end.
+        :return: list of (bucket start, bytes, packets) tuples, oldest first. Buckets without samples are omitted.
+        """
+        buckets = dict()
+        origin = start
+        for timestamp, _, bytes, packets in self._deltas(start, end):
+            if origin is None:
+                origin = timestamp
+            bucket = origin + (timestamp - origin) // step * step
+            total_bytes, total_packets = buckets.get(bucket, (0, 0))
+            buckets[bucket] = (total_bytes + bytes, total_packets + packets)
+        return [(bucket,) + buckets[bucket] for bucket in sorted(buckets)]
@@ -131,9 +131,9 @@ class Ipset:
         :retur: bool was the entry found.
         """
         if type(entry) is Entry:
-            args = [entry.elem]
+            args = [self.name, entry.elem]
         else:
-            args = [entry]
+            args = [self.name, entry]
 
         success, _, err = _run_cmd("test", args)
 
@@ -55,6 +55,17 @@ class Net:
         logger.info("Connecting MAC %s (\"%s\" on mark %s)", mac, name, mark)
         self.ipset.add(Entry(mac, skbmark=mark, comment=name))
 
+    def is_connected(self, mac):
+        """
+        Check if an user is in the ipsets.
+        Equivalent to:
+        `ipset test langate <mac>`
+
+        :param mac: mac address of the user.
+        :return: True if the user is connected.
+        """
+        return self.ipset.test(mac)
+
     def disconnect_user(self, mac):
         """
         Remove an entry from the ipsets.
@@ -119,6 +130,17 @@ class Net:
         logger.info("Devices currently connected: %s", len(users))
         return users
 
+    def get_counters(self):
+        """
+        Get bandwidth counters of all entries from the set.
+        Equivalent to:
+        `ipset list langate`
+
+        :return: Dictionary mapping mac to a (bytes, packets) tuple
+        """
+        entries = self.ipset.list().entries
+        return {entry.elem: (entry.bytes or 0, entry.packets or 0) for entry in entries}
+
     def delete(self):
         """
         Delete the set. After calling this function, the sets can't be used anymore as it no longer exist.
@@ -2,6 +2,11 @@ import config
 import os, struct, traceback
 import socket, pickle
 import traceback
+import threading
+import selectors
+from time import monotonic, sleep
+from admission import Admission, Busy
+from history import HistoryWriter, HistoryError
 from ipset import IpsetError
 from managed import Net, User, get_ip, get_mac
 from log import logger, init_logger
@@ -37,40 +42,115 @@ Example format of a *response* payload, sent back by this daemon :
 
 The success parameter is mandatory and is a boolean value.
 If False, the only other value in the dict is the corresponding error message raised 
-by the ipset class.
+by the ipset class, unless the daemon is overloaded :
+
+    {
+        "success": False,
+        "busy": True,
+        "retry_after": 0.25,
+        "message": "queue lookup is full"
+    }
+
+Cheap lookups (get_mac, get_ip) are served by their own worker thread, so they never
+wait behind kernel operations. These are run one at a time by another worker, per-user
+operations before heavy administrative ones (clear, destroy). Each class has a bounded
+queue, and each client process a limit of queries in flight; when either is exceeded
+the query is refused right away, and the client should retry after `retry_after` seconds.
+The "get_stats" query is answered immediately, with queue depths and rejection counts.
+
+Bandwidth counters of connected users are regularly sampled to a persistent usage
+history (see history.py), and once more right before "clear", "destroy" or
+"disconnect_user" drop them. "connect_user" records a zero sample when it adds a new
+entry, as its counters start from 0.
 
 Note that this daemon needs to be executed on the same machine as the one that serves the pages because it needs to access the ARP tables to find the mac adresses of the hosts that are using the web server.
 
 """
 
 net = Net(mark=config.mark)
+admission = Admission(config.query_classes, config.max_client_inflight)
+
+# the usage history is optional, it must not prevent access control from running
+try:
+    history = HistoryWriter(config.history_dir)
+except (OSError, HistoryError):
+    logger.exception("Could not open usage history at %s, running without it", config.history_dir)
+    history = None
 
-# the 3 following helper functions were taken from https://stackoverflow.com/questions/17667903/python-socket-receive-large-amount-of-data
+# set once the ipset is destroyed, there are no more counters to record then
+destroyed = False
+
+# queries queued by the daemon itself, refused when sent by clients
+internal_queries = {"record_usage"}
+
+# the following helper function was taken from https://stackoverflow.com/questions/17667903/python-socket-receive-large-amount-of-data
 
 def _send(sock, data):
     pack = struct.pack('>I', len(data)) + data
     sock.sendall(pack)
 
-def _recv_bytes(sock, size):
-    data = b''
-    while len(data) < size:
-        r = sock.recv(size - len(data))
-        if not r:
-            return None
-        data += r
-    return data
-
-def _recv(sock):
-    data_length_r = _recv_bytes(sock, 4)
+def _payload(data):
+    """
+    Extract the payload of a message being received.
 
-    if not data_length_r:
+    :param data: bytes received so far.
+    :return: the payload, None if it is not complete yet.
+    """
+    if len(data) < 4:
         return None
-
-    data_length = struct.unpack('>I', data_length_r)[0]
-    return _recv_bytes(sock, data_length)
+    data_length = struct.unpack('>I', data[:4])[0]
+    if len(data) < 4 + data_length:
+        return None
+    return data[4:4 + data_length]
     
 
+def _record_usage(mac=None):
+    """
+    Append the current counters of users to the usage history.
+    Only samples of all users are flushed to disk, single user ones are left
+    to the next periodic sample so as not to block the worker on disk writes.
+
+    :param mac: mac address of the only user to record, None for all users.
+    """
+    if history is None or destroyed:
+        return
+    try:
+        counters = net.get_counters()
+        if mac is not None:
+            counters = {m: c for m, c in counters.items() if m == mac.upper()}
+        history.append_all(counters)
+        if mac is None:
+            history.flush()
+    except Exception:
+        traceback.print_exc()
+
+def _record_restart(mac):
+    """
+    Append a zero sample for a user just added to the set, its counters starting from 0.
+
+    :param mac: mac address of the user.
+    """
+    if history is None:
+        return
+    try:
+        history.append(mac, 0, 0)
+    except Exception:
+        traceback.print_exc()
+
+def _sampler():
+    """
+    Periodically queue an internal "record_usage" query, so that sampling the
+    counters is serialized with the other ipset operations by their worker.
+    """
+    while not destroyed:
+        sleep(config.history_interval)
+        try:
+            admission.submit(None, {"query": "record_usage"})
+        except Busy as e:
+            logger.warning("Skipping usage sample: %s", e.reason)
+
 def parse_query(p):
+    global destroyed
     response = {
         "success": True
     }
@@ -78,17 +158,27 @@ def parse_query(p):
     try:
 
         if p["query"] == "connect_user":
+            # an entry already in the set keeps its counters
+            new = not net.is_connected(p["mac"])
             net.connect_user(p["mac"], p["name"].replace('"',''))
+            if new:
+                _record_restart(p["mac"])
         elif p["query"] == "disconnect_user":
+            _record_usage(p["mac"])
             net.disconnect_user(p["mac"])
         elif p["query"] == "get_user_info":
             response["info"] = net.get_user_info(p["mac"]).to_dict()
         elif p["query"] == "set_mark":
             net.set_vpn(p["mac"], p["mark"])
         elif p["query"] == "clear":
+            _record_usage()
             net.clear()
         elif p["query"] == "destroy":
+            _record_usage()
             net.delete()
+            destroyed = True
+        elif p["query"] == "record_usage":
+            _record_usage()
         elif p["query"] == "get_ip":
             response["ip"] = get_ip(p["mac"])
         elif p["query"] == "get_mac":
@@ -105,6 +195,71 @@ def parse_query(p):
     else:
         return response
 
+def _peer(sock):
+    """
+    Identify the process on the other side of the socket, for per-client limits.
+
+    :return: pid of the client, None if it can't be known.
+    """
+    try:
+        creds = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i'))
+    except (AttributeError, OSError):
+        return None
+    return struct.unpack('3i', creds)[0]
+
+def _dispatch(client, q):
+    """
+    Answer a query right away, or queue it for its worker.
+
+    :param client: socket of the client.
+    :param q: the query payload.
+    """
+    if q.get("query") == "get_stats":
+        _send(client, pickle.dumps({"success": True, "stats": admission.get_stats()}))
+        client.close()
+        return
+
+    if q.get("query") in internal_queries or admission.classify(q) is None:
+        logger.warning("Refusing unknown query %s", q.get("query"))
+        _send(client, pickle.dumps({
+            "success": False,
+            "message": "unknown query {}".format(q.get("query"))
+        }))
+        client.close()
+        return
+
+    try:
+        admission.submit(client, q, _peer(client))
+    except Busy as e:
+        _send(client, pickle.dumps(e.to_dict()))
+        client.close()
+
+def _worker(name):
+    """
+    Serve the queries queued for a worker one at a time, highest priority first.
+    Internal queries have no client to answer to.
+
+    :param name: name of the worker.
+    """
+    while True:
+        request = admission.get(name)
+        start = monotonic()
+        try:
+            if request.expired:
+                start = None
+                r = admission.busy(request).to_dict()
+            else:
+                r = parse_query(request.query)
+            if request.client is not None:
+                _send(request.client, pickle.dumps(r))
+            logger.debug("Order finished")
+        except Exception:
+            traceback.print_exc()
+        finally:
+            if request.client is not None:
+                request.client.close()
+            admission.done(request, monotonic() - start if start is not None else None)
+
 if os.path.exists(config.netcontrol_socket_file):
     os.remove(config.netcontrol_socket_file)
 
@@ -114,21 +269,67 @@ with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as server:
     logger.info("Binding socket at \"{}\"".format(config.netcontrol_socket_file))
     server.bind(config.netcontrol_socket_file)
 
+    server.listen(config.listen_backlog)
     logger.info("Listening on \"{}\".".format(config.netcontrol_socket_file))
 
+    for worker in admission.workers:
+        threading.Thread(target=_worker, args=(worker,), daemon=True).start()
+    threading.Thread(target=_sampler, daemon=True).start()
+
+    server.setblocking(False)
+    selector = selectors.DefaultSelector()
+    selector.register(server, selectors.EVENT_READ)
+    pending = dict() # client -> [bytes received so far, deadline]
+
+    def _drop(client):
+        """
+        Close a client, forgetting it if its query was still being received.
+        """
+        if client in pending:
+            selector.unregister(client)
+            del pending[client]
+        client.close()
+
     while True:
-        try:
-            server.listen(1)
-            client, _ = server.accept()
-            logger.debug("Incoming connection")
+        timeout = None
+        if pending:
+            timeout = max(0, min(deadline for _, deadline in pending.values()) - monotonic())
 
-            # TODO: authenticate packet
-            q = pickle.loads(_recv(client))
+        for key, _ in selector.select(timeout):
+            client = None
+            try:
+                if key.fileobj is server:
+                    client, _ = server.accept()
+                    logger.debug("Incoming connection")
+                    client.setblocking(False)
+                    pending[client] = [b'', monotonic() + config.client_timeout]
+                    selector.register(client, selectors.EVENT_READ)
+                    continue
 
-            r = parse_query(q)
+                client = key.fileobj
+                data = client.recv(65536)
+                if not data:
+                    _drop(client)
+                    continue
+                pending[client][0] += data
+                payload = _payload(pending[client][0])
+                if payload is None:
+                    continue
 
-            _send(client, pickle.dumps(r))
-            logger.debug("Order finished")
-            client.close()
-        except Exception:
-            traceback.print_exc()
+                selector.unregister(client)
+                del pending[client]
+                client.setblocking(True)
+                client.settimeout(config.client_timeout)
+
+                # TODO: authenticate packet
+                _dispatch(client, pickle.loads(payload))
+            except Exception:
+                traceback.print_exc()
+                if client is not None:
+                    _drop(client)
+
+        now = monotonic()
+        for client, (_, deadline) in list(pending.items()):
+            if deadline <= now:
+                logger.warning("Client did not send its query in time, closing")
+                _drop(client)